@@ -6,12 +6,15 @@ __author__ = "Wei Kang weikang9009@gmail.com, \
               Pedro Amaral pedroamaral@cedeplar.ufmg.br, \
               Pablo Estrada pabloestradace@gmail.com"
 
+import weakref
 import numpy as np
 import numpy.linalg as la
+from libpysal import weights
 from scipy import sparse as sp
+from scipy.linalg import cho_factor, cho_solve, solve
 from scipy.sparse.linalg import splu as SuperLU
 from .utils import RegressionPropsY, RegressionPropsVM, inverse_prod, set_warn
-from .sputils import spdot, spfill_diagonal, spinv
+from .sputils import spdot
 from . import diagnostics as DIAG
 from . import user_output as USER
 from . import summary_output as SUMMARY
@@ -25,6 +28,11 @@ from .panel_utils import check_panel, demean_panel
 
 __all__ = ["Panel_FE_Lag", "Panel_FE_Error"]
 
+# eigenvalues of W by weights object, see _lag_evals
+_EVALS_CACHE = weakref.WeakKeyDictionary()
+# weights objects that already passed check_weights, see _check_weights
+_W_CHECK_CACHE = weakref.WeakKeyDictionary()
+
 
 class BasePanel_FE_Lag(RegressionPropsY, RegressionPropsVM):
 
@@ -95,46 +103,59 @@ class BasePanel_FE_Lag(RegressionPropsY, RegressionPropsVM):
         # Demeaned variables
         self.y = demean_panel(y, self.n, self.t)
         self.x = demean_panel(x, self.n, self.t)
-        # Big W matrix
-        W = w.full()[0]
+        # Stacked (n*t)x1 vectors are handled internally as t x n arrays,
+        # one row per period, so that I_t kron W is applied as W to each row
+        Y = self.y.reshape(self.t, self.n)
+        # W is only used in sparse form
         Wsp = w.sparse
-        Wsp_nt = sp.kron(sp.identity(self.t), Wsp, format="csr")
         # lag dependent variable
-        ylag = spdot(Wsp_nt, self.y)
+        ylag = spdot(Wsp, Y.T).T
         # b0, b1, e0 and e1
         xtx = spdot(self.x.T, self.x)
-        xtxi = la.inv(xtx)
         xty = spdot(self.x.T, self.y)
-        xtyl = spdot(self.x.T, ylag)
-        b0 = spdot(xtxi, xty)
-        b1 = spdot(xtxi, xtyl)
-        e0 = self.y - spdot(self.x, b0)
-        e1 = ylag - spdot(self.x, b1)
+        xtyl = spdot(self.x.T, ylag.reshape(-1, 1))
+        # both regressions through one Cholesky factorization of x'x
+        b01 = cho_solve(cho_factor(xtx), np.hstack((xty, xtyl)))
+        b0, b1 = b01[:, :1], b01[:, 1:]
+        e0 = Y - spdot(self.x, b0).reshape(self.t, self.n)
+        e1 = ylag - spdot(self.x, b1).reshape(self.t, self.n)
+        # cross-products of e0 and e1, so that e'e is O(1) for each rho
+        s00 = np.sum(e0 * e0)
+        s01 = np.sum(e0 * e1)
+        s11 = np.sum(e1 * e1)
+
+        # eigenvalues of W for the Jacobian, ln|I - rho W| = sum ln|1 - rho ev|
+        evals = _lag_evals(w)
+        # real eigenvalues, and one of each pair of complex conjugates
+        evals_r = evals[evals.imag == 0].real
+        evals_c = evals[evals.imag > 0]
 
         # concentrated Log Likelihood
-        I = sp.identity(self.n)
-        res = minimize_scalar(lag_c_loglik_sp, 0.0, bounds=(-1.0, 1.0),
-                              args=(self.n, self.t, e0, e1, I, Wsp),
+        res = minimize_scalar(lag_c_loglik_ord, 0.0, bounds=(-1.0, 1.0),
+                              args=(self.n, self.t, s00, s01, s11,
+                                    evals_r, evals_c),
                               method='bounded', options={"xatol": epsilon})
-        self.rho = res.x[0][0]
+        self.rho = res.x
 
         # compute full log-likelihood, including constants
         ln2pi = np.log(2.0 * np.pi)
         llik = (- res.fun
                 - (self.n * self.t) / 2.0 * ln2pi
                 - (self.n * self.t) / 2.0)
-        self.logll = llik[0][0]
+        self.logll = llik
 
         # b, residuals and predicted values
         b = b0 - self.rho * b1
         self.betas = np.vstack((b, self.rho))   # rho added as last coefficient
-        self.u = e0 - self.rho * e1
+        self.u = (e0 - self.rho * e1).reshape(-1, 1)
         self.predy = self.y - self.u
 
-        xb = spdot(self.x, b)
+        xb = spdot(self.x, b).reshape(self.t, self.n)
 
-        self.predy_e = inverse_prod(
-            Wsp_nt, xb, self.rho, inv_method="power_exp", threshold=epsilon)
+        # (I_t kron (I - rho W))^-1 xb, expanded on all periods at once
+        predy_e = inverse_prod(
+            Wsp, xb.T, self.rho, inv_method="power_exp", threshold=epsilon)
+        self.predy_e = predy_e.T.reshape(-1, 1)
         self.e_pred = self.y - self.predy_e
 
         # residual variance
@@ -142,39 +163,39 @@ class BasePanel_FE_Lag(RegressionPropsY, RegressionPropsVM):
         self.sig2 = spdot(self.u.T, self.u) / (self.n * self.t)
 
         # information matrix
-        a = -self.rho * W
-        spfill_diagonal(a, 1.0)
-        ai = spinv(a)
-        wai = spdot(Wsp, ai)
-        tr1 = wai.diagonal().sum()  # same for sparse and dense
-
-        wai2 = spdot(wai, wai)
-        tr2 = wai2.diagonal().sum()
-
-        waiTwai = spdot(wai.T, wai)
-        tr3 = waiTwai.diagonal().sum()
-
-        wai_nt = sp.kron(sp.identity(self.t), wai, format="csr")
-        wpredy = spdot(wai_nt, xb)
-        xTwpy = spdot(x.T, wpredy)
-
-        waiTwai_nt = sp.kron(sp.identity(self.t), waiTwai, format="csr")
-        wTwpredy = spdot(waiTwai_nt, xb)
-        wpyTwpy = spdot(xb.T, wTwpredy)
+        # tr(WA^-1) and tr(WA^-1 WA^-1) are sums over the eigenvalues of W
+        evd = evals / (1.0 - self.rho * evals)
+        tr1 = np.sum(evd).real
+        tr2 = np.sum(evd * evd).real
+
+        # WA^-1 = A^-1 W, with A = I - rho W factorized in sparse form; a
+        # dense copy of W is the right-hand side in place of the identity,
+        # so A^-1 itself is never formed
+        a = sp.identity(self.n) - self.rho * Wsp
+        wai = SuperLU(a.tocsc()).solve(Wsp.toarray())
+        # tr((WA^-1)'WA^-1) is the squared Frobenius norm of WA^-1
+        tr3 = np.einsum('ij,ij->', wai, wai)
+
+        # (I_t kron WA^-1) xb, contracted with x period by period
+        wpredy = spdot(wai, xb.T).T
+        xTwpy = np.einsum('tnk,tn->k', x.reshape(self.t, self.n, self.k),
+                          wpredy, optimize='greedy')
+        wpyTwpy = np.einsum('tn,tn->', wpredy, wpredy)
 
         # order of variables is beta, rho, sigma2
-        v1 = np.vstack(
-            (xtx / self.sig2, xTwpy.T / self.sig2, np.zeros((1, self.k))))
-        v2 = np.vstack(
-            (xTwpy / self.sig2, self.t*(tr2 + tr3) + wpyTwpy / self.sig2, self.t*tr1 / self.sig2))
-        v3 = np.vstack(
-            (np.zeros((self.k, 1)), self.t*tr1 / self.sig2, self.n*self.t / (2.0 * self.sig2**2)))
-
-        v = np.hstack((v1, v2, v3))
-
-        self.vm1 = la.inv(v)  # vm1 includes variance for sigma2
+        k = self.k
+        sig2 = self.sig2[0][0]
+        v = np.zeros((k + 2, k + 2))
+        v[:k, :k] = xtx / sig2
+        v[:k, k] = v[k, :k] = xTwpy / sig2
+        v[k, k] = self.t*(tr2 + tr3) + wpyTwpy / sig2
+        v[k, k + 1] = v[k + 1, k] = self.t*tr1 / sig2
+        v[k + 1, k + 1] = self.n*self.t / (2.0 * sig2**2)
+
+        # vm1 includes variance for sigma2
+        self.vm1 = solve(v, np.eye(k + 2), assume_a='sym')
         self.vm = self.vm1[:-1, :-1]  # vm is for coefficients only
-        self.varb = la.inv(np.hstack((v1[:-1], v2[:-1])))
+        self.varb = solve(v[:-1, :-1], np.eye(k + 1), assume_a='sym')
         self.n = self.n * self.t  # change the n, for degree of freedom
 
 
@@ -305,7 +326,7 @@ class Panel_FE_Lag(BasePanel_FE_Lag):
         bigy, bigx, name_y, name_x, warn = check_panel(y, x_constant, w,
                                                        name_y, name_x)
         set_warn(self, warn)
-        USER.check_weights(w, bigy, w_required=True, time=True)
+        _check_weights(w, bigy)
 
         BasePanel_FE_Lag.__init__(
             self, bigy, bigx, w, epsilon=epsilon)
@@ -390,7 +411,6 @@ class BasePanel_FE_Error(RegressionPropsY, RegressionPropsVM):
         self.y = demean_panel(y, self.n, self.t)
         self.x = demean_panel(x, self.n, self.t)
         # Big W matrix
-        W = w.full()[0]
         Wsp = w.sparse
         Wsp_nt = sp.kron(sp.identity(self.t), Wsp, format="csr")
         # lag dependent variable
@@ -433,17 +453,15 @@ class BasePanel_FE_Error(RegressionPropsY, RegressionPropsVM):
         varb = self.sig2 * xsxsi
 
         # variance-covariance matrix lambda, sigma
-        a = -self.lam * W
-        spfill_diagonal(a, 1.0)
-        ai = spinv(a)
-        wai = spdot(Wsp, ai)
+        # WA^-1 = A^-1 W, with A = I - lam W factorized in sparse form; a
+        # dense copy of W is the right-hand side in place of the identity,
+        # so A^-1 itself is never formed
+        a = sp.identity(self.n) - self.lam * Wsp
+        wai = SuperLU(a.tocsc()).solve(Wsp.toarray())
         tr1 = wai.diagonal().sum()
-
-        wai2 = spdot(wai, wai)
-        tr2 = wai2.diagonal().sum()
-
-        waiTwai = spdot(wai.T, wai)
-        tr3 = waiTwai.diagonal().sum()
+        # tr(WA^-1 WA^-1) and tr((WA^-1)'WA^-1) without forming the products
+        tr2 = np.einsum('ij,ji->', wai, wai)
+        tr3 = np.einsum('ij,ij->', wai, wai)
 
         v1 = np.vstack((self.t * (tr2 + tr3),
                         self.t * tr1 / self.sig2))
@@ -586,7 +604,7 @@ class Panel_FE_Error(BasePanel_FE_Error):
         bigy, bigx, name_y, name_x, warn = check_panel(y, x_constant, w,
                                                        name_y, name_x)
         set_warn(self, warn)
-        USER.check_weights(w, bigy, w_required=True, time=True)
+        _check_weights(w, bigy)
 
         BasePanel_FE_Error.__init__(self, bigy, bigx, w, epsilon=epsilon)
         self.title = "MAXIMUM LIKELIHOOD SPATIAL ERROR PANEL" + \
@@ -601,17 +619,80 @@ class Panel_FE_Error(BasePanel_FE_Error):
         SUMMARY.Panel_FE_Error(reg=self, w=w, vm=vm)
 
 
-def lag_c_loglik_sp(rho, n, t, e0, e1, I, Wsp):
-    # concentrated log-lik for lag model, sparse algebra
+def _check_weights(w, y):
+    """
+    USER.check_weights for panel data, skipped when the same weights object
+    already passed it for a y of the same shape.
+
+    Parameters
+    ----------
+    w           : pysal W object
+                  Spatial weights object
+    y           : array
+                  (n*t)x1 array for dependent variable
+    """
+    if not isinstance(w, weights.W):
+        USER.check_weights(w, y, w_required=True, time=True)
+        return
+    # w.sparse is rebuilt when the weights or their transformation change
+    cached = _W_CHECK_CACHE.get(w)
+    if cached is not None and cached[0] is w.sparse and cached[1] == y.shape:
+        return
+    USER.check_weights(w, y, w_required=True, time=True)
+    _W_CHECK_CACHE[w] = (w.sparse, y.shape)
+
+
+def _lag_evals(w):
+    """
+    Eigenvalues of W, reused across fits that share the same weights object.
+
+    Parameters
+    ----------
+    w           : pysal W object
+                  Spatial weights object
+
+    Returns
+    -------
+    evals       : array
+                  n array with the (possibly complex) eigenvalues of W
+    """
+    Wsp = w.sparse
+    cached = _EVALS_CACHE.get(w)
+    # w.sparse is rebuilt when the weights or their transformation change
+    if cached is not None and cached[0] is Wsp:
+        return cached[1]
+    # a row-standardized binary W, i.e. one with equal weights within each
+    # row, is D^-1 B; if B is symmetric W has the eigenvalues of the
+    # symmetric D^-1/2 B D^-1/2
+    nnz_row = np.diff(Wsp.indptr)
+    w_binary = np.allclose(
+        Wsp.data, np.repeat(1.0 / np.maximum(nnz_row, 1), nnz_row))
+    B = Wsp.copy()
+    B.data = np.ones_like(B.data)
+    if w_binary and (B != B.T).nnz == 0:
+        di12 = sp.diags(1.0 / np.sqrt(np.maximum(nnz_row, 1)))
+        evals = la.eigvalsh((di12 @ B @ di12).toarray())
+    else:
+        evals = la.eigvals(Wsp.toarray())
+    _EVALS_CACHE[w] = (Wsp, evals)
+    return evals
+
+
+def lag_c_loglik_ord(rho, n, t, s00, s01, s11, evals_r, evals_c):
+    # concentrated log-lik for lag model, Ord eigenvalue method
+    # s00, s01 and s11 are e0'e0, e0'e1 and e1'e1, so er'er is expanded
+    # evals_r are the real eigenvalues of W and evals_c one of each complex
+    # conjugate pair, which together add ln|1 - rho ev|^2 in real arithmetic
     if isinstance(rho, np.ndarray):
         if rho.shape == (1, 1):
             rho = rho[0][0]
-    er = e0 - rho * e1
-    sig2 = spdot(er.T, er)
+    sig2 = s00 - 2.0 * rho * s01 + rho * rho * s11
     nlsig2 = (n*t / 2.0) * np.log(sig2)
-    a = I - rho * Wsp
-    LU = SuperLU(a.tocsc())
-    jacob = t * np.sum(np.log(np.abs(LU.U.diagonal())))
+    jacob = np.sum(np.log(np.abs(1.0 - rho * evals_r)))
+    if evals_c.size:
+        jacob += np.sum(np.log((1.0 - rho * evals_c.real) ** 2
+                               + (rho * evals_c.imag) ** 2))
+    jacob = t * jacob
     clike = nlsig2 - jacob
     return clike
 
@@ -633,7 +714,10 @@ def err_c_loglik_sp(lam, n, t, y, ylag, x, xlag, I, Wsp):
     sig2 = ee[0][0]
     nlsig2 = (n*t / 2.0) * np.log(sig2)
     a = I - lam * Wsp
-    LU = SuperLU(a.tocsc())
+    # spatial weights are (nearly) structurally symmetric, so order on the
+    # pattern of A'+A and favor diagonal pivots
+    LU = SuperLU(a.tocsc(), permc_spec="MMD_AT_PLUS_A",
+                 options=dict(SymmetricMode=True))
     jacob = t * np.sum(np.log(np.abs(LU.U.diagonal())))
     # this is the negative of the concentrated log lik for minimization
     clik = nlsig2 - jacob
@@ -7,8 +7,6 @@ __author__ = "Wei Kang weikang9009@gmail.com, \
               Pablo Estrada pabloestradace@gmail.com"
 
 import numpy as np
-from scipy import sparse as sp
-from .sputils import spdot
 
 __all__ = ["check_panel", "demean_panel"]
 
@@ -103,9 +101,9 @@ def demean_panel(arr, n, t, phi=0):
                   Demeaned variable
     """
 
-    one = np.ones((t, 1))
-    J = sp.identity(t) - (1-phi)*(1/t)*spdot(one, one.T)
-    Q = sp.kron(J, sp.identity(n), format="csr")
-    arr_dm = spdot(Q, arr)
+    # Equivalent to (J kron I_n) arr, with J = I_t - (1-phi)/t 11'
+    arr_nt = arr.reshape(t, n, -1)
+    arr_dm = arr_nt - (1-phi) * arr_nt.mean(axis=0, keepdims=True)
+    arr_dm = arr_dm.reshape(arr.shape)
 
     return arr_dm
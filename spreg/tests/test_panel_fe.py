@@ -1,8 +1,10 @@
 import unittest
+from unittest import mock
 import libpysal
 import numpy as np
-from spreg.panel_fe import Panel_FE_Lag, Panel_FE_Error
+from spreg.panel_fe import Panel_FE_Lag, Panel_FE_Error, _EVALS_CACHE
 from libpysal.common import RTOL
+from spreg import user_output as USER
 
 
 class Test_Panel_FE_Lag(unittest.TestCase):
@@ -87,5 +89,102 @@ class Test_Panel_FE_Error(unittest.TestCase):
         np.testing.assert_allclose(reg.schwarz, schwarz, RTOL)
 
 
+class Test_Panel_FE_Weights(unittest.TestCase):
+    """Asymmetric (KNN) and non-binary (inverse distance) weights, checked
+    against the sparse LU estimates."""
+    def setUp(self):
+        shp = libpysal.examples.get_path("columbus.shp")
+        self.w_knn = libpysal.weights.KNN.from_shapefile(shp, k=4)
+        self.w_knn.transform = 'r'
+        thr = libpysal.weights.min_threshold_dist_from_shapefile(shp)
+        self.w_invd = libpysal.weights.DistanceBand.from_shapefile(
+            shp, threshold=thr, binary=False)
+        self.w_invd.transform = 'r'
+        rs = np.random.RandomState(12345)
+        self.x = rs.normal(size=(49 * 3, 2))
+        self.y = (np.dot(self.x, np.array([[1.0], [-0.5]]))
+                  + rs.normal(size=(49 * 3, 1)))
+
+    def test_Lag_KNN(self):
+        reg = Panel_FE_Lag(self.y, self.x, w=self.w_knn)
+        betas = np.array([[1.0208243367], [-0.2511820837], [-0.0393174932]])
+        np.testing.assert_allclose(reg.betas, betas, RTOL)
+        vm = np.array([0.0081614249, 0.0086782092, 0.0114689208])
+        np.testing.assert_allclose(reg.vm.diagonal(), vm, RTOL)
+        np.testing.assert_allclose(reg.sig2, 0.8103049179838829, RTOL)
+        np.testing.assert_allclose(reg.logll, -559.941932177996, RTOL)
+        np.testing.assert_allclose(reg.u[0], [-0.5685597454], RTOL)
+
+    def test_Lag_InvDistance(self):
+        reg = Panel_FE_Lag(self.y, self.x, w=self.w_invd)
+        betas = np.array([[1.0319724943], [-0.2502355797], [0.0623145322]])
+        np.testing.assert_allclose(reg.betas, betas, RTOL)
+        vm = np.array([0.0081707052, 0.0086602224, 0.0083829314])
+        np.testing.assert_allclose(reg.vm.diagonal(), vm, RTOL)
+        np.testing.assert_allclose(reg.sig2, 0.8084797849080514, RTOL)
+        np.testing.assert_allclose(reg.logll, -559.8279078977008, RTOL)
+        np.testing.assert_allclose(reg.u[0], [-0.5730938571], RTOL)
+
+    def test_Error_KNN(self):
+        reg = Panel_FE_Error(self.y, self.x, w=self.w_knn)
+        betas = np.array([[1.0269070874], [-0.2521251085], [0.0661538901]])
+        np.testing.assert_allclose(reg.betas, betas, RTOL)
+        vm = np.array([0.0081023061, 0.0087050703, 0.014559214])
+        np.testing.assert_allclose(reg.vm.diagonal(), vm, RTOL)
+        np.testing.assert_allclose(reg.sig2, 0.809036893191088, RTOL)
+        np.testing.assert_allclose(reg.logll, -559.8680882702081, RTOL)
+        np.testing.assert_allclose(reg.u[0], [-0.5625655309], RTOL)
+
+    def test_Error_InvDistance(self):
+        reg = Panel_FE_Error(self.y, self.x, w=self.w_invd)
+        betas = np.array([[1.0312205695], [-0.2556397223], [0.1160801041]])
+        np.testing.assert_allclose(reg.betas, betas, RTOL)
+        vm = np.array([0.0078646685, 0.0085489069, 0.0111134025])
+        np.testing.assert_allclose(reg.vm.diagonal(), vm, RTOL)
+        np.testing.assert_allclose(reg.sig2, 0.802568720928284, RTOL)
+        np.testing.assert_allclose(reg.logll, -559.4724693478449, RTOL)
+        np.testing.assert_allclose(reg.u[0], [-0.5600044539], RTOL)
+
+
+class Test_Panel_FE_Cache(unittest.TestCase):
+    def setUp(self):
+        self.w = libpysal.io.open(
+            libpysal.examples.get_path("columbus.gal"), "r").read()
+        self.w.transform = 'r'
+        rs = np.random.RandomState(12345)
+        self.x = rs.normal(size=(49 * 3, 2))
+        self.y = (np.dot(self.x, np.array([[1.0], [-0.5]]))
+                  + rs.normal(size=(49 * 3, 1)))
+
+    def test_evals_cache(self):
+        wsp = self.w.sparse
+        Panel_FE_Lag(self.y, self.x, w=self.w)
+        # fitting does not touch the weights object
+        self.assertIs(self.w.sparse, wsp)
+        self.assertEqual(self.w.transform, 'R')
+        evals = _EVALS_CACHE[self.w][1]
+        Panel_FE_Lag(self.y, self.x, w=self.w)
+        self.assertIs(_EVALS_CACHE[self.w][1], evals)
+        # a new transformation invalidates the cached eigenvalues
+        self.w.transform = 'b'
+        Panel_FE_Lag(self.y, self.x, w=self.w)
+        self.assertIsNot(_EVALS_CACHE[self.w][1], evals)
+        np.testing.assert_allclose(
+            np.sort(_EVALS_CACHE[self.w][1].real),
+            np.sort(np.linalg.eigvals(self.w.full()[0]).real), atol=1e-10)
+
+    def test_weights_check_cache(self):
+        with mock.patch.object(USER, "check_weights",
+                               wraps=USER.check_weights) as check:
+            for i in range(4):
+                Panel_FE_Lag(self.y, self.x, w=self.w)
+            Panel_FE_Error(self.y, self.x, w=self.w)
+            self.assertEqual(check.call_count, 1)
+            # a new transformation runs the check again
+            self.w.transform = 'b'
+            Panel_FE_Lag(self.y, self.x, w=self.w)
+            self.assertEqual(check.call_count, 2)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -539,6 +539,10 @@ def inverse_prod(w, data, scalar, post_multiply=False, inv_method="power_exp", t
     >>> inv_reg = inverse_prod(w, data, rho, inv_method="true_inv", post_multiply=True)
     >>> np.allclose(inv_pow, inv_reg, atol=0.0001)
     True
+    >>> # rho passed as an array, as done by the GM lag and combo models
+    >>> inv_arr = inverse_prod(w, data, np.array([rho]), inv_method="power_exp")
+    >>> np.allclose(inv_arr, inverse_prod(w, data, rho, inv_method="power_exp"))
+    True
 
     """
     if inv_method == "power_exp":
@@ -577,19 +581,22 @@ def power_expansion(w, data, scalar, post_multiply=False, threshold=0.0000000001
         ws = w.sparse
     except:
         ws = w
+    # scale W once so that each term is a single product with the previous one;
+    # scalar may come in as a (1,) or (1, 1) array
+    rws = ws * np.asarray(scalar).item()
     if post_multiply:
         data = data.T
     running_total = copy.copy(data)
-    increment = copy.copy(data)
+    increment = data
     count = 1
     test = 10000000
     if max_iterations == None:
         max_iterations = 10000000
     while test > threshold and count <= max_iterations:
         if post_multiply:
-            increment = increment * ws * scalar
+            increment = increment * rws
         else:
-            increment = ws * increment * scalar
+            increment = rws * increment
         running_total += increment
         test_old = test
         test = la.norm(increment)